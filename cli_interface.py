@@ -1,5 +1,9 @@
 """Terminal interface for real-time P2P messaging"""
 
+import os
+import queue
+import selectors
+import sys
 import threading
 from typing import Optional
 
@@ -7,21 +11,47 @@ from typing import Optional
 class TerminalInterface:
     """Clean terminal interface for chatting"""
     
+    POLL_INTERVAL = 0.2  # Seconds between checks of self.running while idle
+    
     def __init__(self, chat_room, nickname: str):
         self.chat_room = chat_room
         self.nickname = nickname
         self.running = True
+        self.displaying = True  # Incoming messages keep printing after 'quit'
+        self._stdin_buffer = b''
     
-    def start(self):
+    def start(self, ready_event: Optional[threading.Event] = None):
         """Start terminal input in background thread"""
         terminal_thread = threading.Thread(
             target=self._input_loop,
+            args=(ready_event,),
             daemon=True
         )
         terminal_thread.start()
+        
+        display_thread = threading.Thread(
+            target=self._display_loop,
+            daemon=True
+        )
+        display_thread.start()
+    
+    def _display_loop(self):
+        """Print messages received by the chat room until stop() is called"""
+        while self.displaying:
+            try:
+                nick, message = self.chat_room.display_queue.get(
+                    timeout=self.POLL_INTERVAL
+                )
+            except queue.Empty:
+                continue
+            
+            print(f"\n📥 {nick}: {message}")
+            if self.running:
+                # Redraw the prompt while input is still being read
+                print(f"[{self.nickname}] ", end='', flush=True)
     
-    def _input_loop(self):
-        """Main chat input loop"""
+    def _input_loop(self, ready_event: Optional[threading.Event] = None):
+        """Main chat input loop, setting ready_event once the banner is shown"""
         print("\n" + "═"*70)
         print("💬 CHAT ACTIVE - Start typing your messages!")
         print("═"*70)
@@ -31,10 +61,25 @@ class TerminalInterface:
         print("  • Press Ctrl+C to shutdown")
         print("═"*70 + "\n")
         
+        if ready_event is not None:
+            ready_event.set()
+        
+        selector = self._create_stdin_selector()
+        prompt_pending = True
+        
         while self.running:
             try:
                 # Get user input
-                message = input(f"[{self.nickname}] ").strip()
+                if selector is not None and prompt_pending:
+                    print(f"[{self.nickname}] ", end='', flush=True)
+                    prompt_pending = False
+                
+                line = self._read_line(selector)
+                if line is None:
+                    continue  # No input yet, re-check self.running
+                
+                prompt_pending = True
+                message = line.strip()
                 
                 # Check for exit commands
                 if message.lower() in ['quit', 'exit', 'q']:
@@ -69,23 +114,80 @@ class TerminalInterface:
             except Exception as e:
                 print(f"⚠️  Input error: {e}")
                 continue
+        
+        if selector is not None:
+            selector.close()
+    
+    def _create_stdin_selector(self) -> Optional[selectors.BaseSelector]:
+        """
+        Create a selector watching stdin
+        
+        Returns:
+            Selector, or None if stdin can't be polled (e.g. on Windows) or
+            isn't a terminal
+        """
+        if sys.platform == 'win32':
+            return None
+        
+        # Piped input may already sit in sys.stdin's buffer after the
+        # input() prompts at startup, where raw os.read() can't see it
+        if not sys.stdin.isatty():
+            return None
+        
+        try:
+            selector = selectors.DefaultSelector()
+            selector.register(sys.stdin, selectors.EVENT_READ)
+            return selector
+        except (ValueError, OSError):
+            return None
+    
+    def _read_line(self, selector: Optional[selectors.BaseSelector]) -> Optional[str]:
+        """
+        Read one line from stdin without blocking past POLL_INTERVAL
+        
+        Args:
+            selector: Selector watching stdin, or None to fall back to input()
+            
+        Returns:
+            The line read, or None if no complete line arrived in time
+            
+        Raises:
+            EOFError: If the input stream was closed
+        """
+        if selector is None:
+            return input(f"[{self.nickname}] ")
+        
+        # Read raw bytes so lines buffered by sys.stdin can't hide from select()
+        while b'\n' not in self._stdin_buffer:
+            if not selector.select(timeout=self.POLL_INTERVAL):
+                return None
+            chunk = os.read(sys.stdin.fileno(), 4096)
+            if not chunk:
+                raise EOFError
+            self._stdin_buffer += chunk
+        
+        line, _, self._stdin_buffer = self._stdin_buffer.partition(b'\n')
+        return line.decode(sys.stdin.encoding or 'utf-8', errors='replace')
     
     def stop(self):
         """Stop the terminal interface"""
         self.running = False
+        self.displaying = False
 
 
-def start_terminal_interface(chat_room, nickname: str) -> Optional[TerminalInterface]:
+def start_terminal_interface(chat_room, nickname: str,
+                             ready_event: Optional[threading.Event] = None) -> Optional[TerminalInterface]:
     """
     Initialize and start terminal interface
     
     Args:
         chat_room: ChatRoom instance
         nickname: User's display name
+        ready_event: Optional event set once the interface is up
         
     Returns:
         TerminalInterface instance
     """
     terminal = TerminalInterface(chat_room, nickname)
-    terminal.start()
+    terminal.start(ready_event)
     return terminal
\ No newline at end of file
@@ -4,10 +4,17 @@ Production-ready with automatic configuration - CORRECTED VERSION
 """
 import sys
 import socket
-import time
-from flask import Flask, jsonify, request
+import threading
+import concurrent.futures
+from flask import Flask, request
 from flask_cors import CORS
 
+try:
+    from waitress import serve
+except ImportError:  # Fall back to Flask's built-in development server
+    serve = None
+
+from p2p import fastjson
 from p2p.host import create_host
 from p2p.discovery import init_mdns
 from p2p.chatroom import join_chat_room
@@ -15,7 +22,7 @@ from cli_interface import start_terminal_interface
 
 # Flask setup with minimal logging
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['ETag', 'X-Last-Seq'])
 
 import logging
 log = logging.getLogger('werkzeug')
@@ -28,18 +35,72 @@ chat_room = None
 peer_discovery = None
 terminal_interface = None
 
+STARTUP_STEP_TIMEOUT = 2.0  # Max seconds to wait for each subsystem to come up
+
+# Peer connects run here so a slow TCP connect doesn't stall discovery
+_connect_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=16,
+    thread_name_prefix='peer-connect'
+)
+_pending_connects = set()  # Peer IDs with a connect already in flight
+_pending_connects_lock = threading.Lock()
+
+
+_response_cache = {}  # endpoint -> (state key, encoded body)
+
+
+def ojsonify(obj, status=200):
+    """jsonify() replacement that encodes with orjson when it is installed"""
+    body = fastjson.dumps(obj)
+    return app.response_class(body, status=status, mimetype='application/json')
 
-def find_free_port(start_port=5000, max_attempts=100):
-    """Find an available port automatically"""
-    for port in range(start_port, start_port + max_attempts):
+
+def cached_ojsonify(endpoint: str, build):
+    """
+    ojsonify() for polled status endpoints
+    
+    build() is only called and re-encoded when the peer list or chat
+    history changed since the endpoint's last response. The state is also
+    sent as a weak ETag, and a matching If-None-Match gets 304.
+    """
+    key = (
+        p2p_host.peers_generation if p2p_host else None,
+        chat_room.get_last_seq() if chat_room else None
+    )
+    # The counters restart with each run, so tag them with this run's peer ID
+    etag = '-'.join(map(str, (p2p_host.peer_id if p2p_host else None,) + key))
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    
+    cached = _response_cache.get(endpoint)
+    if cached is not None and cached[0] == key:
+        response = app.response_class(cached[1], mimetype='application/json')
+    else:
+        response = ojsonify(build())
+        _response_cache[endpoint] = (key, response.get_data())
+    
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def find_free_port(preferred_port=5000):
+    """Find an available port, preferring preferred_port, else one the OS picks"""
+    for port in (preferred_port, 0):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if sys.platform != 'win32':
+            # Don't count ports stuck in TIME_WAIT from a previous run as busy.
+            # (On Windows SO_REUSEADDR would also allow binding a port in use.)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.bind(('', port))
-            sock.close()
-            return port
+            return sock.getsockname()[1]
         except OSError:
             continue
-    raise RuntimeError(f"No available ports found in range {start_port}-{start_port + max_attempts}")
+        finally:
+            sock.close()
+    raise RuntimeError("No available ports found")
 
 
 def get_user_input():
@@ -70,18 +131,40 @@ def get_user_input():
 
 @app.route('/messages', methods=['GET'])
 def get_messages():
-    """Get all chat messages"""
-    if chat_room:
-        return jsonify(chat_room.get_messages())
-    return jsonify([])
+    """
+    Get chat messages
+    
+    With ?since=<seq> only messages newer than that sequence number are
+    returned. The newest sequence number is sent back in the X-Last-Seq
+    header and, with this run's peer ID, in the ETag; a matching
+    If-None-Match gets 304 Not Modified.
+    """
+    if not chat_room:
+        return ojsonify([])
+    
+    # Sequence numbers restart with each run, so tag them with this run's peer ID
+    last_seq = chat_room.get_last_seq()
+    etag = f"{chat_room.peer_id}-{last_seq}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    
+    since = request.args.get('since', default=0, type=int)
+    messages, last_seq = chat_room.get_messages_since(since)
+    
+    response = ojsonify(messages)
+    response.set_etag(f"{chat_room.peer_id}-{last_seq}", weak=True)
+    response.headers['X-Last-Seq'] = str(last_seq)
+    return response
 
 
 @app.route('/messages/raw', methods=['GET'])
 def get_raw_messages():
     """Get all messages in raw format (with metadata)"""
     if chat_room:
-        return jsonify(chat_room.get_raw_messages())
-    return jsonify([])
+        return ojsonify(chat_room.get_raw_messages())
+    return ojsonify([])
 
 
 @app.route('/send', methods=['POST'])
@@ -89,73 +172,83 @@ def send_message():
     """Send a chat message"""
     try:
         # FIX: Improved input validation
-        data = request.get_json()
+        # Parse the raw body directly rather than via request.get_json()
+        body = request.get_data(cache=False) or b'{}'
+        try:
+            data = fastjson.loads(body)
+        except ValueError:
+            return ojsonify({
+                "status": "error", 
+                "message": "Invalid JSON"
+            }, 400)
         
         if not data:
-            return jsonify({
+            return ojsonify({
                 "status": "error", 
                 "message": "No data provided"
-            }), 400
+            }, 400)
         
         if not isinstance(data, dict):
-            return jsonify({
+            return ojsonify({
                 "status": "error", 
                 "message": "Invalid data format"
-            }), 400
+            }, 400)
         
         message = data.get('message', '').strip()
         
         if not message:
-            return jsonify({
+            return ojsonify({
                 "status": "error", 
                 "message": "Empty message"
-            }), 400
+            }, 400)
         
         if len(message) > 1000:
-            return jsonify({
+            return ojsonify({
                 "status": "error", 
                 "message": "Message too long (max 1000 characters)"
-            }), 400
+            }, 400)
         
         if not chat_room:
-            return jsonify({
+            return ojsonify({
                 "status": "error", 
                 "message": "Chat not ready"
-            }), 503
+            }, 503)
         
-        success = chat_room.publish(message)
+        success = chat_room.publish_now(message)
         
-        return jsonify({
+        return ojsonify({
             "status": "success",
             "message": "Message sent" if success else "Message saved (no peers connected)"
-        }), 200
+        }, 200)
             
     except Exception as e:
-        return jsonify({
+        return ojsonify({
             "status": "error", 
             "message": f"Internal error: {str(e)}"
-        }), 500
+        }, 500)
 
 
 @app.route('/peers', methods=['GET'])
 def get_peers():
     """Get list of connected peers"""
     if p2p_host:
-        peers_dict = p2p_host.get_peers()
-        peers = [{"peer_id": pid, "address": f"{ip}:{port}"} 
-                 for pid, (ip, port) in peers_dict.items()]
-        return jsonify({
-            "self_id": p2p_host.peer_id,
-            "peers": peers,
-            "peer_count": len(peers)
-        })
-    return jsonify({"self_id": "unknown", "peers": [], "peer_count": 0})
+        def build():
+            peers_dict = p2p_host.get_peers()
+            peers = [{"peer_id": pid, "address": f"{ip}:{port}"} 
+                     for pid, (ip, port) in peers_dict.items()]
+            return {
+                "self_id": p2p_host.peer_id,
+                "peers": peers,
+                "peer_count": len(peers)
+            }
+        return cached_ojsonify('peers', build)
+    return ojsonify({"self_id": "unknown", "peers": [], "peer_count": 0})
 
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """System health check"""
-    return jsonify({
+    return cached_ojsonify('health', lambda: {
         "status": "healthy",
         "peer_id": p2p_host.peer_id if p2p_host else "unknown",
         "room": chat_room.room_name if chat_room else "unknown",
@@ -168,17 +261,17 @@ def health_check():
 def room_info():
     """Get current room information"""
     if chat_room:
-        return jsonify(chat_room.get_room_info())
-    return jsonify({"error": "Not connected"}), 503
+        return cached_ojsonify('room-info', chat_room.get_room_info)
+    return ojsonify({"error": "Not connected"}, 503)
 
 
 @app.route('/status', methods=['GET'])
 def get_status():
     """Get detailed system status"""
     if not chat_room or not p2p_host:
-        return jsonify({"error": "System not initialized"}), 503
+        return ojsonify({"error": "System not initialized"}, 503)
     
-    return jsonify({
+    return cached_ojsonify('status', lambda: {
         "room_name": chat_room.room_name,
         "nickname": chat_room.nickname,
         "peer_id": p2p_host.peer_id,
@@ -191,20 +284,36 @@ def get_status():
 # Error handlers
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({"error": "Endpoint not found"}), 404
+    return ojsonify({"error": "Endpoint not found"}, 404)
 
 
 @app.errorhandler(500)
 def internal_error(error):
-    return jsonify({"error": "Internal server error"}), 500
+    return ojsonify({"error": "Internal server error"}, 500)
 
 
 # ==================== P2P INITIALIZATION ====================
 
 def on_peer_discovered(peer_id: str, peer_ip: str, peer_port: int):
-    """Handle newly discovered peer"""
-    if p2p_host:
+    """Handle newly discovered peer by connecting in the background"""
+    if not p2p_host:
+        return
+    
+    with _pending_connects_lock:
+        if peer_id in _pending_connects:
+            return
+        _pending_connects.add(peer_id)
+    
+    _connect_pool.submit(_connect_to_peer, peer_id, peer_ip, peer_port)
+
+
+def _connect_to_peer(peer_id: str, peer_ip: str, peer_port: int):
+    """Connect to a discovered peer (runs on _connect_pool)"""
+    try:
         p2p_host.connect_to_peer(peer_ip, peer_port, peer_id)
+    finally:
+        with _pending_connects_lock:
+            _pending_connects.discard(peer_id)
 
 
 def initialize_p2p(p2p_port: int, room_name: str, nickname: str):
@@ -215,10 +324,14 @@ def initialize_p2p(p2p_port: int, room_name: str, nickname: str):
     print("🚀 Starting DisasterConnect...")
     print("─"*70)
     
+    # Each step waits for the previous subsystem to report it is ready
+    ready = threading.Event()
+    
     # Step 1: Create P2P Host
     print("\n[1/4] 🔧 Initializing P2P network...")
-    p2p_host = create_host(p2p_port)
-    time.sleep(0.5)
+    p2p_host = create_host(p2p_port, ready_event=ready)
+    ready.wait(STARTUP_STEP_TIMEOUT)
+    ready.clear()
     
     # Step 2: Start Peer Discovery
     print("[2/4] 📡 Starting peer discovery...")
@@ -226,19 +339,23 @@ def initialize_p2p(p2p_port: int, room_name: str, nickname: str):
         peer_id=p2p_host.peer_id,
         p2p_port=p2p_port,
         rendezvous=room_name,
-        on_peer_found=on_peer_discovered
+        on_peer_found=on_peer_discovered,
+        ready_event=ready
     )
-    time.sleep(0.5)
+    ready.wait(STARTUP_STEP_TIMEOUT)
+    ready.clear()
     
     # Step 3: Join Chat Room
     print("[3/4] 💬 Joining chat room...")
-    chat_room = join_chat_room(room_name, nickname, p2p_host.peer_id, p2p_host)
-    time.sleep(0.5)
+    chat_room = join_chat_room(room_name, nickname, p2p_host.peer_id, p2p_host,
+                               ready_event=ready)
+    ready.wait(STARTUP_STEP_TIMEOUT)
+    ready.clear()
     
     # Step 4: Start Terminal Interface
     print("[4/4] ⌨️  Starting terminal interface...")
-    terminal_interface = start_terminal_interface(chat_room, nickname)
-    time.sleep(0.5)
+    terminal_interface = start_terminal_interface(chat_room, nickname, ready_event=ready)
+    ready.wait(STARTUP_STEP_TIMEOUT)
     
     # Success summary
     print("\n" + "═"*70)
@@ -260,17 +377,49 @@ def run_flask(http_port: int):
     print(f"⚠️  Press Ctrl+C to stop\n")
     
     try:
-        app.run(
-            host='0.0.0.0',
-            port=http_port,
-            debug=False,
-            use_reloader=False,
-            threaded=True
-        )
+        if serve is not None:
+            # Single process: the P2P host and chat room live in this process
+            serve(app, host='0.0.0.0', port=http_port, threads=16)
+        else:
+            app.run(
+                host='0.0.0.0',
+                port=http_port,
+                debug=False,
+                use_reloader=False,
+                threaded=True
+            )
     except Exception as e:
         print(f"\n❌ Flask server error: {e}")
 
 
+def shutdown():
+    """Stop every subsystem that was started, newest first"""
+    print("\n\n" + "="*70)
+    print("🛑 Shutting down DisasterConnect...")
+    print("="*70)
+    
+    if terminal_interface:
+        terminal_interface.stop()
+        print("✓ Terminal interface stopped")
+    
+    if peer_discovery:
+        peer_discovery.stop()
+        print("✓ Peer discovery stopped")
+    
+    _connect_pool.shutdown(wait=False)
+    
+    if chat_room:
+        # Don't drop messages still waiting for their batch window
+        try:
+            chat_room.flush()
+        except Exception as e:
+            print(f"⚠️  Could not send queued messages: {e}")
+    
+    if p2p_host:
+        p2p_host.stop()
+        print("✓ P2P host stopped")
+
+
 # ==================== MAIN ENTRY POINT ====================
 
 if __name__ == '__main__':
@@ -289,26 +438,16 @@ if __name__ == '__main__':
         # Initialize P2P system
         initialize_p2p(p2p_port, room_name, nickname)
         
-        # Start HTTP server (blocking call)
+        # Start HTTP server (blocking call). waitress handles Ctrl+C itself
+        # and returns normally, so shut down here as well as on the exception
         run_flask(http_port)
         
-    except KeyboardInterrupt:
-        print("\n\n" + "="*70)
-        print("🛑 Shutting down DisasterConnect...")
-        print("="*70)
-        
-        if terminal_interface:
-            terminal_interface.stop()
-            print("✓ Terminal interface stopped")
-        
-        if peer_discovery:
-            peer_discovery.stop()
-            print("✓ Peer discovery stopped")
-        
-        if p2p_host:
-            p2p_host.stop()
-            print("✓ P2P host stopped")
+        shutdown()
+        print("\n👋 Goodbye! Thanks for using DisasterConnect\n")
+        sys.exit(0)
         
+    except KeyboardInterrupt:
+        shutdown()
         print("\n👋 Goodbye! Thanks for using DisasterConnect\n")
         sys.exit(0)
         
@@ -316,5 +455,6 @@ if __name__ == '__main__':
         print(f"\n❌ Fatal Error: {e}")
         import traceback
         traceback.print_exc()
+        shutdown()
         print("\nPlease try restarting the application.\n")
         sys.exit(1)
@@ -1,26 +1,64 @@
 """Chat room with message history and real-time sync - CORRECTED VERSION"""
 
+import itertools
+import queue
+import sys
 import threading
-import uuid
-from dataclasses import dataclass, asdict
-from typing import List, Set
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, List, Optional, Tuple
 from datetime import datetime
 
+# Drop the per-instance __dict__ where dataclasses support it (Python 3.10+)
+_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
 
-@dataclass
+
+def _format_timestamp(timestamp) -> str:
+    """Format a nanosecond timestamp for display (older peers send ISO strings)"""
+    if isinstance(timestamp, int):
+        try:
+            return datetime.fromtimestamp(timestamp / 1e9).isoformat()
+        except (OverflowError, OSError, ValueError):
+            pass  # Out of range for this platform, show it raw
+    return str(timestamp)
+
+
+@dataclass(**_SLOTS)
 class ChatMessage:
     """Chat message with metadata and unique ID"""
     Message: str
     SenderID: str
     SenderNick: str
     MessageID: str = None  # FIX: Add unique message ID
-    Timestamp: str = None
+    Timestamp: int = None  # Nanoseconds since the epoch
+    _dict: dict = field(init=False, repr=False, compare=False)
+    _formatted: str = field(default=None, init=False, repr=False, compare=False)
+    seq: int = field(default=0, init=False, repr=False, compare=False)  # Local history position
     
     def __post_init__(self):
-        if self.MessageID is None:
-            self.MessageID = str(uuid.uuid4())[:12]
         if self.Timestamp is None:
-            self.Timestamp = datetime.now().isoformat()
+            self.Timestamp = time.time_ns()
+        if self.MessageID is None:
+            self.MessageID = f"{self.SenderID}:{self.Timestamp}"
+        
+        # Fields don't change after creation, so build the wire/API dict once
+        self._dict = {
+            'Message': self.Message,
+            'SenderID': self.SenderID,
+            'SenderNick': self.SenderNick,
+            'MessageID': self.MessageID,
+            'Timestamp': self.Timestamp
+        }
+    
+    @property
+    def formatted(self) -> str:
+        """Display line '[time] nick: message', built on first use and cached"""
+        if self._formatted is None:
+            self._formatted = (
+                f"[{_format_timestamp(self.Timestamp)}] {self.SenderNick}: {self.Message}"
+            )
+        return self._formatted
 
 
 class ChatRoom:
@@ -29,49 +67,111 @@ class ChatRoom:
     Handles message broadcasting and receiving
     """
     
+    MAX_HISTORY = 1000  # Oldest messages are evicted beyond this
+    MAX_SEEN_IDS = 5000  # Oldest message IDs are forgotten beyond this
+    MAX_DISPLAY_BACKLOG = 1000  # Undisplayed incoming messages kept for the UI
+    BATCH_MAX_SIZE = 32  # Max messages per outgoing batch
+    BATCH_WINDOW = 0.05  # Seconds to wait for more messages before sending
+    
     def __init__(self, room_name: str, nickname: str, peer_id: str, p2p_host):
         self.room_name = room_name
         self.nickname = nickname
         self.peer_id = peer_id
         self.p2p_host = p2p_host
-        self.messages: List[ChatMessage] = []
+        self.messages: Deque[ChatMessage] = deque(maxlen=self.MAX_HISTORY)
         self.message_lock = threading.Lock()
-        self.seen_message_ids: Set[str] = set()  # FIX: Track by message ID
+        # FIX: Track by message ID (insertion-ordered set, oldest first)
+        self.seen_message_ids: "OrderedDict[str, None]" = OrderedDict()
+        self.last_seq = 0  # Sequence number of the newest message in history
+        self._msg_counter = itertools.count(1)  # Numbers our own MessageIDs
+        
+        # Incoming (nick, message) pairs waiting to be shown by the UI thread
+        self.display_queue: "queue.Queue[Tuple[str, str]]" = queue.Queue(
+            maxsize=self.MAX_DISPLAY_BACKLOG
+        )
+        
+        # Outgoing messages are coalesced into batches by the flusher thread.
+        # Messages only leave the outbox under send_lock, which keeps the
+        # flusher and publish_now() from overtaking each other
+        self.outbox: Deque[ChatMessage] = deque()
+        self.outbox_ready = threading.Condition()
+        self.send_lock = threading.Lock()
+        flush_thread = threading.Thread(
+            target=self._flush_outbox,
+            daemon=True
+        )
+        flush_thread.start()
         
         # Register to receive messages
         self.p2p_host.add_message_handler(self._handle_incoming_message)
     
+    def _create_message(self, message: str) -> ChatMessage:
+        """Create our own message and save it to local history"""
+        # peer_id is random per run, so "<peer_id>:<n>" is unique without a UUID
+        chat_msg = ChatMessage(
+            Message=message,
+            SenderID=self.peer_id,
+            SenderNick=self.nickname,
+            MessageID=f"{self.peer_id}:{next(self._msg_counter)}"
+        )
+        
+        with self.message_lock:
+            self._append_message(chat_msg)
+        
+        return chat_msg
+    
     def publish(self, message: str) -> bool:
         """
-        Send message to all connected peers
+        Queue message for broadcast to all connected peers
+        
+        Messages published within BATCH_WINDOW seconds of each other are
+        sent to peers as a single batch.
         
         Args:
             message: Text message to send
+        
+        Returns:
+            True if at least one peer is connected to receive it
+        """
+        try:
+            chat_msg = self._create_message(message)
+            with self.outbox_ready:
+                self.outbox.append(chat_msg)
+                self.outbox_ready.notify()
             
+            # Show send confirmation
+            if self.get_peer_count() > 0:
+                print(f"📤 You: {message}")
+                return True
+            else:
+                # No peers yet, but message saved
+                print(f"📝 You: {message}")
+                return False
+        
+        except Exception as e:
+            print(f"❌ Failed to send: {e}")
+            return False
+    
+    def publish_now(self, message: str) -> bool:
+        """
+        Send message to all connected peers immediately, without waiting
+        for the batch window
+        
+        Messages already waiting in the outbox are sent first, so this
+        never overtakes earlier publish() calls.
+        
+        Args:
+            message: Text message to send
+        
         Returns:
             True if sent successfully to at least one peer
         """
         try:
-            # Create message object with unique ID
-            chat_msg = ChatMessage(
-                Message=message,
-                SenderID=self.peer_id,
-                SenderNick=self.nickname
-            )
+            chat_msg = self._create_message(message)
+            with self.outbox_ready:
+                self.outbox.append(chat_msg)
             
-            # Save to local history
-            with self.message_lock:
-                self.messages.append(chat_msg)
-                self.seen_message_ids.add(chat_msg.MessageID)
-            
-            # Broadcast to peers
-            broadcast_data = {
-                'type': 'chat_message',
-                'room': self.room_name,
-                'data': asdict(chat_msg)
-            }
-            
-            success_count = self.p2p_host.broadcast_message(broadcast_data)
+            success_count = self.flush()
             
             # Show send confirmation
             if success_count > 0:
@@ -81,29 +181,98 @@ class ChatRoom:
                 # No peers yet, but message saved
                 print(f"📝 You: {message}")
                 return False
-                
+        
         except Exception as e:
             print(f"❌ Failed to send: {e}")
             return False
     
+    def _flush_outbox(self):
+        """Wait up to BATCH_WINDOW for a batch to fill, then send the outbox"""
+        while True:
+            with self.outbox_ready:
+                self.outbox_ready.wait_for(lambda: self.outbox)
+                self.outbox_ready.wait_for(
+                    lambda: len(self.outbox) >= self.BATCH_MAX_SIZE,
+                    timeout=self.BATCH_WINDOW
+                )
+            
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Failed to send: {e}")
+    
+    def flush(self) -> int:
+        """
+        Send everything in the outbox now, BATCH_MAX_SIZE messages at a time
+        
+        Returns:
+            Number of peers that received the last batch (0 if none was sent)
+        """
+        success_count = 0
+        with self.send_lock:
+            while True:
+                with self.outbox_ready:
+                    batch = [
+                        self.outbox.popleft()
+                        for _ in range(min(len(self.outbox), self.BATCH_MAX_SIZE))
+                    ]
+                if not batch:
+                    return success_count
+                
+                if len(batch) == 1:
+                    broadcast_data = {
+                        'type': 'chat_message',
+                        'room': self.room_name,
+                        'data': batch[0]._dict
+                    }
+                else:
+                    broadcast_data = {
+                        'type': 'chat_message_batch',
+                        'room': self.room_name,
+                        'data': [msg._dict for msg in batch]
+                    }
+                
+                success_count = self.p2p_host.broadcast_message(broadcast_data)
+    
     def _handle_incoming_message(self, message_data: dict):
         """
-        Handle incoming message from peer
+        Handle incoming message (or message batch) from peer
         
         Args:
             message_data: Dictionary with message data
         """
         try:
-            # Filter by message type
-            if message_data.get('type') != 'chat_message':
-                return
-            
             # Filter by room
             if message_data.get('room') != self.room_name:
                 return
             
-            # Parse message
-            data = message_data.get('data', {})
+            # Filter by message type
+            message_type = message_data.get('type')
+            if message_type == 'chat_message':
+                self._receive_message(message_data.get('data', {}))
+            elif message_type == 'chat_message_batch':
+                for data in message_data.get('data', []):
+                    self._receive_message(data)
+        
+        except Exception as e:
+            print(f"⚠️  Error handling message: {e}")
+    
+    def _receive_message(self, data: dict):
+        """
+        Store and display a single chat message received from a peer
+        
+        Args:
+            data: Dictionary with ChatMessage fields
+        """
+        try:
+            # Don't show our own messages again
+            if data.get('SenderID') == self.peer_id:
+                return
+            
+            # Cheap unlocked peek for duplicates before building a ChatMessage;
+            # the authoritative check is repeated under the lock below
+            if data.get('MessageID') in self.seen_message_ids:
+                return
             
             # Validate required fields
             if not all(key in data for key in ['Message', 'SenderID', 'SenderNick']):
@@ -112,28 +281,48 @@ class ChatRoom:
             
             chat_msg = ChatMessage(**data)
             
-            # Don't show our own messages again
-            if chat_msg.SenderID == self.peer_id:
-                return
-            
             # FIX: Improved duplicate detection using message ID
             with self.message_lock:
                 if chat_msg.MessageID in self.seen_message_ids:
                     return  # Already seen this message
                 
                 # Add to history
-                self.messages.append(chat_msg)
-                self.seen_message_ids.add(chat_msg.MessageID)
-                
-                # Display message
-                print(f"\n📥 {chat_msg.SenderNick}: {chat_msg.Message}")
-                print(f"[{self.nickname}] ", end='', flush=True)
+                self._append_message(chat_msg)
+            
+            # Hand off for display; terminal I/O doesn't belong on this thread
+            self._queue_for_display(chat_msg)
                 
         except TypeError as e:
             print(f"⚠️  Message parsing error: {e}")
         except Exception as e:
             print(f"⚠️  Error handling message: {e}")
     
+    def _queue_for_display(self, chat_msg: ChatMessage):
+        """Queue message for the UI, dropping the oldest one if the UI lags behind"""
+        item = (chat_msg.SenderNick, chat_msg.Message)
+        try:
+            self.display_queue.put_nowait(item)
+        except queue.Full:
+            try:
+                self.display_queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.display_queue.put_nowait(item)
+            except queue.Full:
+                pass
+    
+    def _append_message(self, chat_msg: ChatMessage):
+        """Number and append to history and remember its ID (lock held)"""
+        self.last_seq += 1
+        chat_msg.seq = self.last_seq
+        self.messages.append(chat_msg)
+        
+        # Peers never re-send messages this old, so the oldest IDs can go
+        self.seen_message_ids[chat_msg.MessageID] = None
+        if len(self.seen_message_ids) > self.MAX_SEEN_IDS:
+            self.seen_message_ids.popitem(last=False)
+    
     def get_messages(self) -> List[str]:
         """
         Get all messages as formatted strings
@@ -142,10 +331,35 @@ class ChatRoom:
             List of message strings with timestamps
         """
         with self.message_lock:
-            return [
-                f"[{msg.Timestamp}] {msg.SenderNick}: {msg.Message}"
-                for msg in self.messages
-            ]
+            messages = list(self.messages)
+        # Format outside the lock so readers don't stall incoming messages
+        return [msg.formatted for msg in messages]
+    
+    def get_messages_since(self, since: int) -> Tuple[List[str], int]:
+        """
+        Get messages added after a given sequence number
+        
+        Args:
+            since: Sequence number of the newest message the caller already has
+            
+        Returns:
+            Tuple of (formatted newer messages, sequence number of newest message)
+        """
+        with self.message_lock:
+            # Sequence numbers are contiguous, so the newest N are the new ones
+            new_count = min(self.last_seq - since, len(self.messages))
+            if new_count <= 0:
+                return [], self.last_seq
+            
+            newest = list(itertools.islice(reversed(self.messages), new_count))
+            last_seq = self.last_seq
+        
+        return [msg.formatted for msg in reversed(newest)], last_seq
+    
+    def get_last_seq(self) -> int:
+        """Get sequence number of the newest message (0 if none)"""
+        with self.message_lock:
+            return self.last_seq
     
     def get_raw_messages(self) -> List[dict]:
         """
@@ -155,7 +369,7 @@ class ChatRoom:
             List of message dictionaries
         """
         with self.message_lock:
-            return [asdict(msg) for msg in self.messages]
+            return [msg._dict for msg in self.messages]
     
     def get_message_count(self) -> int:
         """Get total message count"""
@@ -186,7 +400,8 @@ class ChatRoom:
             }
 
 
-def join_chat_room(room_name: str, nickname: str, peer_id: str, p2p_host) -> ChatRoom:
+def join_chat_room(room_name: str, nickname: str, peer_id: str, p2p_host,
+                   ready_event: Optional[threading.Event] = None) -> ChatRoom:
     """
     Join or create a chat room
     
@@ -195,10 +410,13 @@ def join_chat_room(room_name: str, nickname: str, peer_id: str, p2p_host) -> Cha
         nickname: User's display name
         peer_id: Unique peer identifier
         p2p_host: P2P host instance
+        ready_event: Optional event set once the room receives messages
         
     Returns:
         ChatRoom instance
     """
     chat_room = ChatRoom(room_name, nickname, peer_id, p2p_host)
     print(f"✓ Joined room: '{room_name}'")
+    if ready_event is not None:
+        ready_event.set()
     return chat_room
@@ -1,17 +1,55 @@
 """Peer discovery using UDP broadcast for local network - CORRECTED VERSION"""
 
+import selectors
 import socket
-import json
 import threading
 import time
-from typing import Callable, Set
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional, Set
+
+from . import fastjson
+from .host import is_valid_peer_id
+
+
+class Announcement(NamedTuple):
+    """Validated contents of a peer_announcement datagram"""
+    peer_id: str
+    p2p_port: int
+    rendezvous: str
+
+
+def _parse_announcement(data: bytes) -> Optional[Announcement]:
+    """
+    Decode and validate an announcement datagram
+    
+    Returns:
+        Announcement, or None if data is not a well-formed announcement
+    """
+    try:
+        message = fastjson.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(message, dict):
+        return None
+    
+    peer_id = message.get('peer_id')
+    p2p_port = message.get('p2p_port')
+    rendezvous = message.get('rendezvous')
+    if not (is_valid_peer_id(peer_id)
+            and isinstance(p2p_port, int) and 0 < p2p_port < 65536
+            and isinstance(rendezvous, str)):
+        return None
+    return Announcement(peer_id, p2p_port, rendezvous)
 
 
 class PeerDiscovery:
     """Peer discovery using UDP broadcast with improved error handling"""
     
     BROADCAST_PORT = 37020
+    BROADCAST_ADDRESS = ('255.255.255.255', BROADCAST_PORT)
     DISCOVERY_INTERVAL = 5
+    MAX_SEEN_ANNOUNCEMENTS = 256  # Raw announcements remembered to skip re-parsing
+    MAX_ANNOUNCEMENT_SIZE = 1024  # Longer datagrams are truncated
     
     def __init__(self, peer_id: str, p2p_port: int, on_peer_found: Callable):
         self.peer_id = peer_id
@@ -19,6 +57,12 @@ class PeerDiscovery:
         self.on_peer_found = on_peer_found
         self.running = False
         self.discovered_peers: Set[str] = set()
+        self.discovered_lock = threading.Lock()
+        # Peers re-send identical bytes every interval; only the listener uses this
+        self._seen_announcements: "OrderedDict[bytes, None]" = OrderedDict()
+        # Datagrams are received into one reused buffer
+        self._recv_buffer = bytearray(self.MAX_ANNOUNCEMENT_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
         
         self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
@@ -26,32 +70,36 @@ class PeerDiscovery:
         
         self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # Lets every instance on this machine share the discovery port
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # stop() writes to _wakeup_send to interrupt the blocking select()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
         
         self.rendezvous = ""
-        self.actual_port = self.BROADCAST_PORT  # Track actual bound port
+        self._announcement_bytes = b""  # Encoded once in start()
     
-    def start(self, rendezvous: str):
-        """Start peer discovery with fallback port binding"""
+    def start(self, rendezvous: str, ready_event: Optional[threading.Event] = None):
+        """Start peer discovery, then set ready_event"""
         self.rendezvous = rendezvous
         self.running = True
         
-        # FIX: Improved port binding with fallback
-        port_bound = False
-        for attempt_port in range(self.BROADCAST_PORT, self.BROADCAST_PORT + 10):
-            try:
-                self.listen_socket.bind(('', attempt_port))
-                self.actual_port = attempt_port
-                port_bound = True
-                
-                if attempt_port != self.BROADCAST_PORT:
-                    print(f"⚠️  Port {self.BROADCAST_PORT} in use, using port {attempt_port}")
-                break
-                
-            except OSError:
-                continue
+        # Nothing in the announcement changes while running, so encode it once
+        self._announcement_bytes = fastjson.dumps({
+            'type': 'peer_announcement',
+            'peer_id': self.peer_id,
+            'p2p_port': self.p2p_port,
+            'rendezvous': rendezvous
+        })
         
-        if not port_bound:
-            print(f"❌ Could not bind discovery port (tried {self.BROADCAST_PORT}-{self.BROADCAST_PORT + 9})")
+        # Other instances share the port too, so there is no fallback to try
+        try:
+            self.listen_socket.bind(('', self.BROADCAST_PORT))
+            port_bound = True
+        except OSError:
+            port_bound = False
+            print(f"❌ Could not bind discovery port {self.BROADCAST_PORT}")
             print(f"⚠️  Peer discovery will be limited - you can still connect manually")
         
         broadcast_thread = threading.Thread(
@@ -68,31 +116,20 @@ class PeerDiscovery:
             listen_thread.start()
         
         print(f"✓ Peer discovery started")
+        
+        if ready_event is not None:
+            ready_event.set()
     
     def _broadcast_presence(self):
         """Periodically broadcast presence"""
         while self.running:
             try:
-                announcement = {
-                    'type': 'peer_announcement',
-                    'peer_id': self.peer_id,
-                    'p2p_port': self.p2p_port,
-                    'rendezvous': self.rendezvous
-                }
-                
-                message = json.dumps(announcement).encode('utf-8')
+                message = self._announcement_bytes
                 
-                # Broadcast to standard port and actual port if different
-                ports_to_try = {self.BROADCAST_PORT, self.actual_port}
-                
-                for port in ports_to_try:
-                    try:
-                        self.broadcast_socket.sendto(
-                            message,
-                            ('255.255.255.255', port)
-                        )
-                    except Exception:
-                        pass  # Broadcast failures are expected
+                try:
+                    self.broadcast_socket.sendto(message, self.BROADCAST_ADDRESS)
+                except Exception:
+                    pass  # Broadcast failures are expected
                         
             except Exception as e:
                 if self.running:
@@ -101,37 +138,47 @@ class PeerDiscovery:
             time.sleep(self.DISCOVERY_INTERVAL)
     
     def _listen_for_peers(self):
-        """Listen for peer announcements"""
-        self.listen_socket.settimeout(1.0)
+        """Listen for peer announcements until stop() wakes the selector"""
+        self.listen_socket.setblocking(False)
+        self._selector.register(self.listen_socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
         
         while self.running:
             try:
-                data, addr = self.listen_socket.recvfrom(1024)
+                ready = self._selector.select()
+                if not any(key.fileobj is self.listen_socket for key, _ in ready):
+                    continue  # Wakeup from stop()
                 
-                try:
-                    message = json.loads(data.decode('utf-8'))
-                except json.JSONDecodeError:
-                    continue  # Skip invalid JSON
+                nbytes, addr = self.listen_socket.recvfrom_into(self._recv_buffer)
+                # Exact-size copy: the seen-announcement cache needs immutable keys
+                data = self._recv_view[:nbytes].tobytes()
+                
+                # Already handled these exact bytes - no need to parse them again
+                if data in self._seen_announcements:
+                    self._seen_announcements.move_to_end(data)
+                    continue
+                self._seen_announcements[data] = None
+                if len(self._seen_announcements) > self.MAX_SEEN_ANNOUNCEMENTS:
+                    self._seen_announcements.popitem(last=False)
+                
+                announcement = _parse_announcement(data)
+                if announcement is None:
+                    continue  # Skip malformed announcements
                 
                 # Skip our own announcements
-                if message.get('peer_id') == self.peer_id:
+                peer_id = announcement.peer_id
+                if peer_id == self.peer_id:
                     continue
                 
                 # Filter by room (rendezvous point)
-                if message.get('rendezvous') != self.rendezvous:
+                if announcement.rendezvous != self.rendezvous:
                     continue
                 
-                peer_id = message.get('peer_id')
-                peer_port = message.get('p2p_port')
+                peer_port = announcement.p2p_port
                 peer_ip = addr[0]
                 
-                # Validate data
-                if not peer_id or not peer_port:
-                    continue
-                
                 # Only trigger callback for new peers
-                if peer_id and peer_id not in self.discovered_peers:
-                    self.discovered_peers.add(peer_id)
+                if self._claim_peer(peer_id):
                     print(f"✓ Discovered peer: {peer_id}")
                     
                     if self.on_peer_found:
@@ -140,20 +187,37 @@ class PeerDiscovery:
                         except Exception as e:
                             print(f"⚠️  Error in peer discovery callback: {e}")
                             
-            except socket.timeout:
-                continue  # Normal timeout
+            except BlockingIOError:
+                continue  # Datagram already consumed
             except Exception as e:
                 if self.running:
                     # Only log unexpected errors while running
                     pass
+        
+        self._selector.close()
+        self._wakeup_recv.close()
+    
+    def _claim_peer(self, peer_id: str) -> bool:
+        """Record peer_id as discovered, returning True if it was new"""
+        with self.discovered_lock:
+            if peer_id in self.discovered_peers:
+                return False
+            self.discovered_peers.add(peer_id)
+            return True
     
     def get_discovered_peers(self) -> Set[str]:
         """Get set of discovered peer IDs"""
-        return self.discovered_peers.copy()
+        with self.discovered_lock:
+            return self.discovered_peers.copy()
     
     def stop(self):
         """Stop peer discovery"""
         self.running = False
+        try:
+            self._wakeup_send.send(b'\0')
+            self._wakeup_send.close()
+        except OSError:
+            pass
         try:
             self.broadcast_socket.close()
         except:
@@ -165,8 +229,9 @@ class PeerDiscovery:
 
 
 def init_mdns(peer_id: str, p2p_port: int, rendezvous: str, 
-              on_peer_found: Callable) -> PeerDiscovery:
+              on_peer_found: Callable,
+              ready_event: Optional[threading.Event] = None) -> PeerDiscovery:
     """Initialize peer discovery service"""
     discovery = PeerDiscovery(peer_id, p2p_port, on_peer_found)
-    discovery.start(rendezvous)
+    discovery.start(rendezvous, ready_event)
     return discovery
@@ -0,0 +1,20 @@
+"""JSON encoding helpers - orjson when installed, standard library otherwise"""
+
+try:
+    import orjson
+
+    # orjson returns bytes directly and accepts bytes/memoryview input
+    dumps = orjson.dumps
+    loads = orjson.loads
+except ImportError:  # Fall back to the (slower) standard library
+    import json
+
+    def dumps(obj) -> bytes:
+        """Serialize obj to UTF-8 encoded JSON bytes"""
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(data):
+        """Deserialize JSON from str, bytes, bytearray or memoryview"""
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
@@ -1,91 +1,413 @@
 """P2P Host for peer-to-peer communication - CORRECTED VERSION"""
 
+import base64
+import ipaddress
+import os
+import queue
+import re
 import socket
-import json
+import select
+import selectors
+import stat
+import struct
+import tempfile
 import threading
-import uuid
-from typing import Callable, Dict, Tuple, List
+import concurrent.futures
+from collections import defaultdict, deque
+from typing import Callable, DefaultDict, Deque, Dict, Tuple, List, Optional
+
+from . import fastjson
+
+
+_LEN = struct.Struct('!I')  # 4-byte big-endian length prefix
+_PEER_ID = re.compile(r'[a-z2-7]{8}')  # lowercase base32 of 5 random bytes
+
+
+def _frame(payload: bytes) -> bytes:
+    """Prefix payload with its 4-byte big-endian length, ready to send"""
+    return _LEN.pack(len(payload)) + payload
+
+
+class _FrameReader:
+    """Reassembles length-prefixed messages from a non-blocking connection"""
+    
+    __slots__ = ('address', 'base_size', 'buffer', 'view', 'filled', 'start',
+                 'needed', 'pending')
+    
+    def __init__(self, address: Tuple[str, int], size: int):
+        self.address = address
+        self.base_size = size  # Buffer size to return to after a large frame
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.filled = 0  # Bytes of buffer holding received data
+        self.start = 0  # Offset of the first byte not yet returned as a frame
+        self.needed = 0  # Size of the incomplete frame at start, once known
+        self.pending: Deque[dict] = deque()  # Decoded, waiting for inbox room
+    
+    def read(self, sock: socket.socket, max_size: int) -> Optional[List[memoryview]]:
+        """
+        Receive what sock has available and split off complete messages
+        
+        Args:
+            sock: Readable non-blocking socket
+            max_size: Largest payload accepted
+        
+        Returns:
+            Views of the complete payloads (valid until the next call), or
+            None if the connection closed
+        
+        Raises:
+            ValueError: If a declared length exceeds max_size
+        """
+        self._compact()
+        try:
+            received = sock.recv_into(self.view[self.filled:])
+        except BlockingIOError:
+            return []
+        if not received:
+            return None
+        self.filled += received
+        
+        frames = []
+        position = self.start
+        while self.filled - position >= _LEN.size:
+            length, = _LEN.unpack_from(self.buffer, position)
+            if length > max_size:
+                raise ValueError(f"message of {length} bytes exceeds limit")
+            end = position + _LEN.size + length
+            if end > self.filled:
+                self.needed = end - position
+                break
+            frames.append(self.view[position + _LEN.size:end])
+            position = end
+        else:
+            self.needed = 0
+        
+        self.start = position
+        return frames
+    
+    def _compact(self):
+        """Move unreturned bytes to the front, resizing for an oversized frame"""
+        remaining = self.filled - self.start
+        if self.start:
+            self.buffer[:remaining] = self.buffer[self.start:self.filled]
+            self.filled, self.start = remaining, 0
+        
+        # Views handed out earlier pin the buffer, so resize by replacing it
+        size = max(self.needed, self.base_size)
+        if size != len(self.buffer) and size >= remaining:
+            buffer = bytearray(size)
+            buffer[:remaining] = self.buffer[:remaining]
+            self.buffer, self.view = buffer, memoryview(buffer)
+
+
+def _is_readable(sock: socket.socket) -> bool:
+    """Check without blocking whether sock has data, EOF or an error pending"""
+    if hasattr(select, 'poll'):
+        # Unlike select(), poll() has no FD_SETSIZE limit on descriptor numbers
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(0))
+    return bool(select.select([sock], [], [], 0)[0])  # Windows: no fd limit
+
+
+def _unix_socket_dir() -> Optional[str]:
+    """
+    Private (0700) directory holding this user's peer sockets
+    
+    Returns:
+        Directory path, or None if Unix sockets are unavailable or the
+        directory exists but could have been planted by another user
+    """
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'getuid'):
+        return None
+    
+    uid = os.getuid()
+    path = os.path.join(tempfile.gettempdir(), f"p2p-{uid}")
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+    except OSError:
+        return None
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != uid
+            or info.st_mode & 0o077):
+        return None
+    return path
+
+
+def is_valid_peer_id(peer_id) -> bool:
+    """True if peer_id has the format P2PHost generates"""
+    return isinstance(peer_id, str) and _PEER_ID.fullmatch(peer_id) is not None
+
+
+def _unix_socket_path(peer_id: str) -> Optional[str]:
+    """
+    Path of the Unix domain socket a peer of this user listens on, if any
+    
+    Returns:
+        Socket path, or None if Unix sockets are unavailable or peer_id
+        could name a file outside the private socket directory
+    """
+    directory = _unix_socket_dir()
+    if directory is None or not is_valid_peer_id(peer_id):
+        return None
+    path = os.path.join(directory, f"{peer_id}.sock")
+    if os.path.dirname(os.path.realpath(path)) != os.path.realpath(directory):
+        return None
+    return path
+
+
+def _is_local_address(ip: str) -> bool:
+    """True if ip is a loopback address or one of this host's own addresses"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    if address.is_loopback:
+        return True
+    
+    # Connecting a UDP socket only picks a route; the kernel uses the
+    # destination itself as the source address when it is a local one
+    family = socket.AF_INET6 if address.version == 6 else socket.AF_INET
+    try:
+        with socket.socket(family, socket.SOCK_DGRAM) as probe:
+            probe.connect((ip, 9))
+            return probe.getsockname()[0] == ip
+    except OSError:
+        return False
 
 
 class P2PHost:
     """P2P Host for peer-to-peer communication with improved reliability"""
     
+    MAX_MESSAGE_SIZE = 1024 * 1024  # Bytes per length-prefixed message
+    RECV_BUFFER_SIZE = 64 * 1024  # Per-connection buffer reused for messages
+    MAX_SEND_WORKERS = 32  # Peers written to in parallel by broadcast_message
+    MAX_PEER_FAILURES = 3  # Consecutive failed sends before a peer is dropped
+    MAX_INBOX_SIZE = 1024  # Received messages waiting for handlers
+    
     def __init__(self, port: int):
         self.port = port
-        self.peer_id = str(uuid.uuid4())[:8]
+        # 40 random bits -> exactly 8 base32 characters, no padding
+        self.peer_id = base64.b32encode(os.urandom(5)).decode('ascii').lower()
         self.peers: Dict[str, Tuple[str, int]] = {}
-        self.peer_failures: Dict[str, int] = {}  # Track connection failures
+        # Immutable copy of peers.items() for lock-free readers, replaced on change
+        self._peers_snapshot: Tuple[Tuple[str, Tuple[str, int]], ...] = ()
+        self.peer_failures: DefaultDict[str, int] = defaultdict(int)  # Track connection failures
+        self.peers_generation = 0  # Bumped whenever self.peers changes
+        # Persistent outgoing connection per peer, each guarded by its own lock
+        self.peer_conns: Dict[str, socket.socket] = {}
+        self.peer_conn_locks: Dict[str, threading.Lock] = {}
         self.message_handlers: List[Callable] = []
         self.running = False
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Same-host peers connect here instead, skipping the loopback TCP stack
+        self.unix_path = _unix_socket_path(self.peer_id)
+        self.unix_socket: Optional[socket.socket] = None
+        self.listen_thread: Optional[threading.Thread] = None
+        # stop() writes to _wakeup_send to interrupt the blocking select()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
         self.peer_lock = threading.Lock()
+        self.send_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.MAX_SEND_WORKERS,
+            thread_name_prefix='p2p-send'
+        )
+        # Handlers run on their own thread, in arrival order. While the inbox
+        # is full, connections with more messages stop being read, so TCP
+        # flow control pushes back on the peers sending them
+        self.inbox: "queue.Queue[Optional[dict]]" = queue.Queue(maxsize=self.MAX_INBOX_SIZE)
+        self._paused: Dict[socket.socket, _FrameReader] = {}
     
-    def start(self) -> str:
-        """Start the P2P host"""
+    def start(self, ready_event: Optional[threading.Event] = None) -> str:
+        """Start the P2P host, setting ready_event once it accepts connections"""
         self.socket.bind(('0.0.0.0', self.port))
         self.socket.listen(5)
-        self.socket.settimeout(1.0)  # FIX: Add timeout for clean shutdown
+        self.socket.setblocking(False)
+        self._selector.register(self.socket, selectors.EVENT_READ)
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)  # Never stall a handler on it
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        if self.unix_path:
+            self._start_unix_listener()
         self.running = True
         
         print(f"✓ P2P Host started (ID: {self.peer_id})")
         
-        listen_thread = threading.Thread(
+        handler_thread = threading.Thread(
+            target=self._run_handlers,
+            daemon=True
+        )
+        handler_thread.start()
+        
+        self.listen_thread = threading.Thread(
             target=self._listen_for_connections,
             daemon=True
         )
-        listen_thread.start()
+        self.listen_thread.start()
+        
+        if ready_event is not None:
+            ready_event.set()
         
         return self.peer_id
     
-    def _listen_for_connections(self):
-        """Listen for incoming peer connections"""
-        while self.running:
-            try:
-                client_socket, address = self.socket.accept()
-                client_socket.settimeout(10.0)
-                
-                thread = threading.Thread(
-                    target=self._handle_peer_connection,
-                    args=(client_socket, address),
-                    daemon=True
-                )
-                thread.start()
-                
-            except socket.timeout:
-                # Normal timeout, check if still running
-                continue
-            except Exception as e:
-                if self.running:
-                    # Only log if we're supposed to be running
-                    pass
+    def _start_unix_listener(self):
+        """Listen on unix_path too; TCP alone still works if this fails"""
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            unix_socket.bind(self.unix_path)
+            unix_socket.listen(5)
+            unix_socket.setblocking(False)
+        except OSError:
+            unix_socket.close()
+            return
+        self.unix_socket = unix_socket
+        self._selector.register(unix_socket, selectors.EVENT_READ)
     
-    def _handle_peer_connection(self, client_socket: socket.socket, address: Tuple[str, int]):
-        """Handle incoming message from peer"""
+    def _listen_for_connections(self):
+        """Accept peers and read their messages until stop() wakes the selector"""
         try:
-            data = client_socket.recv(4096).decode('utf-8')
-            if data:
-                message = json.loads(data)
-                
-                # Reset failure count for this peer if message received
-                peer_id = message.get('peer_id')
-                if peer_id and peer_id in self.peer_failures:
-                    self.peer_failures[peer_id] = 0
+            while self.running:
+                if self._paused:
+                    self._resume_paused()
                 
-                for handler in self.message_handlers:
+                # Poll while paused in case a handler-thread wakeup was missed
+                timeout = 0.1 if self._paused else None
+                for key, _ in self._selector.select(timeout):
+                    if key.data is not None:
+                        try:
+                            self._read_connection(key.fileobj, key.data)
+                        except Exception as e:
+                            # One misbehaving peer must not stop the listener
+                            print(f"⚠️  Error reading from {key.data.address[0]}: {e}")
+                            self._drop_connection(key.fileobj)
+                        continue
+                    if key.fileobj is self._wakeup_recv:
+                        # Wakeup from stop() or from handlers freeing inbox room
+                        try:
+                            self._wakeup_recv.recv(4096)
+                        except OSError:
+                            pass
+                        continue
+                    
                     try:
-                        handler(message)
+                        client_socket, address = key.fileobj.accept()
+                        # Peers keep their connection open between messages
+                        client_socket.setblocking(False)
+                        if key.fileobj is self.unix_socket:
+                            address = ('localhost', 0)  # Unix peers have no address
+                        else:
+                            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                        
+                        self._selector.register(
+                            client_socket, selectors.EVENT_READ,
+                            _FrameReader(address, self.RECV_BUFFER_SIZE)
+                        )
+                        
+                    except BlockingIOError:
+                        continue  # Client gave up before we accepted
                     except Exception as e:
-                        print(f"⚠️  Message handler error: {e}")
-        except json.JSONDecodeError as e:
-            print(f"⚠️  Invalid JSON received: {e}")
-        except Exception as e:
-            pass  # Connection errors are expected
+                        if self.running:
+                            # Only log if we're supposed to be running
+                            pass
         finally:
-            try:
+            for key in list(self._selector.get_map().values()):
+                if key.data is not None:
+                    key.fileobj.close()
+            for client_socket in list(self._paused):
                 client_socket.close()
-            except:
-                pass
+            self._paused.clear()
+            self._selector.close()
+            self._wakeup_recv.close()
+    
+    def _read_connection(self, client_socket: socket.socket, reader: _FrameReader):
+        """Decode newly arrived messages and queue them in the inbox"""
+        try:
+            frames = reader.read(client_socket, self.MAX_MESSAGE_SIZE)
+        except ValueError:
+            print(f"⚠️  Oversized message from {reader.address[0]}, dropping connection")
+            frames = None
+        except OSError:
+            frames = None  # Connection errors are expected
+        
+        if frames is None:
+            self._drop_connection(client_socket)
+            return
+        
+        for payload in frames:
+            try:
+                message = fastjson.loads(payload)
+            except Exception as e:  # Includes RecursionError on deep nesting
+                print(f"⚠️  Invalid JSON received: {e}")
+                continue
+            
+            if isinstance(message, dict):
+                reader.pending.append(message)
+        
+        if not self._enqueue_pending(reader):
+            # Inbox full - stop reading this peer until handlers catch up
+            self._selector.unregister(client_socket)
+            self._paused[client_socket] = reader
+    
+    def _enqueue_pending(self, reader: _FrameReader) -> bool:
+        """Move reader's decoded messages into the inbox, False if it filled up"""
+        while reader.pending:
+            try:
+                self.inbox.put_nowait(reader.pending[0])
+            except queue.Full:
+                return False
+            reader.pending.popleft()
+        return True
+    
+    def _resume_paused(self):
+        """Start reading paused connections again once their messages fit"""
+        for client_socket, reader in list(self._paused.items()):
+            if not self._enqueue_pending(reader):
+                return
+            del self._paused[client_socket]
+            self._selector.register(client_socket, selectors.EVENT_READ, reader)
+    
+    def _run_handlers(self):
+        """Pass inbox messages to the handlers until stop()"""
+        while self.running:
+            message = self.inbox.get()
+            if message is None:
+                break  # Sentinel from stop()
+            
+            if self._paused:
+                # Room again - have the listener resume paused connections
+                try:
+                    self._wakeup_send.send(b'\0')
+                except OSError:
+                    pass
+            
+            self._dispatch_message(message)
+    
+    def _drop_connection(self, client_socket: socket.socket):
+        """Stop watching an inbound connection and close it"""
+        try:
+            self._selector.unregister(client_socket)
+        except (KeyError, ValueError):
+            pass  # Already unregistered
+        self._paused.pop(client_socket, None)
+        try:
+            client_socket.close()
+        except OSError:
+            pass
+    
+    def _dispatch_message(self, message: dict):
+        """Pass a received message to every registered handler"""
+        # Reset failure count for this peer if message received
+        peer_id = message.get('peer_id')
+        if peer_id:
+            self._reset_failures(peer_id)
+        
+        for handler in self.message_handlers:
+            try:
+                handler(message)
+            except Exception as e:
+                print(f"⚠️  Message handler error: {e}")
     
     def connect_to_peer(self, peer_ip: str, peer_port: int, peer_id: str) -> bool:
         """Connect to a discovered peer"""
@@ -97,6 +419,7 @@ class P2PHost:
                 
                 self.peers[peer_id] = (peer_ip, peer_port)
                 self.peer_failures[peer_id] = 0  # Initialize failure counter
+                self._peers_changed()
             
             # Send handshake
             handshake = {'type': 'handshake', 'peer_id': self.peer_id}
@@ -108,94 +431,220 @@ class P2PHost:
             print(f"⚠️  Failed to connect to peer {peer_id}: {e}")
             return False
     
-    def _send_to_peer(self, peer_id: str, message: dict):
-        """Send message to single peer with retry logic"""
-        try:
+    def _reset_failures(self, peer_id: str):
+        """Clear a peer's failure count without re-adding an evicted peer"""
+        # Lock-free check first: the count is almost always already zero
+        if self.peer_failures.get(peer_id):
             with self.peer_lock:
-                if peer_id not in self.peers:
-                    return
-                ip, port = self.peers[peer_id]
-            
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if peer_id in self.peer_failures:
+                    self.peer_failures[peer_id] = 0
+    
+    def _peers_changed(self):
+        """Publish a new peers snapshot after self.peers was modified (lock held)"""
+        self._peers_snapshot = tuple(self.peers.items())
+        self.peers_generation += 1
+    
+    def _open_connection(self, peer_id: str, ip: str, port: int) -> socket.socket:
+        """Open a persistent connection to a peer, over a Unix socket if local"""
+        unix_path = _unix_socket_path(peer_id) if _is_local_address(ip) else None
+        if unix_path and os.path.exists(unix_path):
+            peer_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             peer_socket.settimeout(3.0)
+            try:
+                peer_socket.connect(unix_path)
+                return peer_socket
+            except OSError:
+                peer_socket.close()  # Stale socket file - fall back to TCP
+        
+        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        peer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        peer_socket.settimeout(3.0)
+        try:
             peer_socket.connect((ip, port))
-            peer_socket.send(json.dumps(message).encode('utf-8'))
+        except OSError:
             peer_socket.close()
+            raise
+        return peer_socket
+    
+    def _close_connection(self, peer_id: str):
+        """Close and forget the persistent connection to a peer, if any"""
+        peer_socket = self.peer_conns.pop(peer_id, None)
+        if peer_socket is not None:
+            try:
+                peer_socket.close()
+            except OSError:
+                pass
+    
+    def _send_frame(self, peer_id: str, ip: str, port: int, frame: bytes):
+        """
+        Write one framed message over the peer's persistent connection
+        
+        Opens the connection on first use. If the pooled connection has gone
+        stale it is replaced and the write retried once.
+        
+        Raises:
+            OSError: If the message could not be sent
+        """
+        with self.peer_lock:
+            if peer_id not in self.peers:
+                raise ConnectionAbortedError("peer was removed")
+            conn_lock = self.peer_conn_locks.setdefault(peer_id, threading.Lock())
+        
+        with conn_lock:
+            # Removal may have happened while we waited for the lock
+            if peer_id not in self.peers:
+                raise ConnectionAbortedError("peer was removed")
+            
+            peer_socket = self.peer_conns.get(peer_id)
+            if peer_socket is not None:
+                try:
+                    # Peers never write back, so readable means closed/reset
+                    if _is_readable(peer_socket):
+                        raise ConnectionResetError("connection closed by peer")
+                    peer_socket.sendall(frame)
+                    return
+                except (OSError, ValueError):
+                    # Peer restarted or dropped the connection - reconnect
+                    self._close_connection(peer_id)
+            
+            peer_socket = self._open_connection(peer_id, ip, port)
+            self.peer_conns[peer_id] = peer_socket
+            try:
+                peer_socket.sendall(frame)
+            except OSError:
+                self._close_connection(peer_id)
+                raise
+    
+    def _send_to_peer(self, peer_id: str, message: dict):
+        """Send message to single peer with retry logic"""
+        try:
+            address = self.peers.get(peer_id)
+            if address is None:
+                return
+            ip, port = address
+            
+            self._send_frame(peer_id, ip, port, _frame(fastjson.dumps(message)))
             
             # Reset failure count on success
-            if peer_id in self.peer_failures:
-                self.peer_failures[peer_id] = 0
+            self._reset_failures(peer_id)
                 
         except Exception as e:
             # FIX: Improved peer removal with retry logic
-            with self.peer_lock:
-                self.peer_failures[peer_id] = self.peer_failures.get(peer_id, 0) + 1
-                
-                # Only remove after 3 consecutive failures
-                if self.peer_failures[peer_id] >= 3:
-                    self.peers.pop(peer_id, None)
-                    self.peer_failures.pop(peer_id, None)
-                    print(f"⚠️  Peer {peer_id} removed after 3 failed attempts")
+            self._record_failure(peer_id, f"{self.MAX_PEER_FAILURES} failed attempts")
     
     def broadcast_message(self, message: dict) -> int:
-        """Broadcast message to all connected peers"""
+        """Broadcast message to all connected peers (in parallel)"""
         message['peer_id'] = self.peer_id
-        message_json = json.dumps(message)
-        successful_sends = 0
+        # Encoded and framed once, then shared by every per-peer send
+        frame = _frame(fastjson.dumps(message))
         
-        with self.peer_lock:
-            peers_copy = list(self.peers.items())
+        peers_copy = self._peers_snapshot  # No lock needed to read
         
-        for peer_id, (ip, port) in peers_copy:
-            try:
-                peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                peer_socket.settimeout(3.0)
-                peer_socket.connect((ip, port))
-                peer_socket.send(message_json.encode('utf-8'))
-                peer_socket.close()
-                successful_sends += 1
+        if len(peers_copy) == 1:
+            # Not worth a thread hand-off
+            peer_id, (ip, port) = peers_copy[0]
+            return int(self._broadcast_to_peer(peer_id, ip, port, frame))
+        
+        futures = [
+            self.send_pool.submit(self._broadcast_to_peer, peer_id, ip, port, frame)
+            for peer_id, (ip, port) in peers_copy
+        ]
+        return sum(
+            future.result()
+            for future in concurrent.futures.as_completed(futures)
+        )
+    
+    def _broadcast_to_peer(self, peer_id: str, ip: str, port: int, frame: bytes) -> bool:
+        """Send one broadcast to a single peer, tracking failures"""
+        try:
+            self._send_frame(peer_id, ip, port, frame)
+            
+            # Reset failure count on success
+            self._reset_failures(peer_id)
+            return True
                 
-                # Reset failure count on success
-                if peer_id in self.peer_failures:
-                    self.peer_failures[peer_id] = 0
-                    
-            except Exception as e:
-                # Track failures but don't remove immediately
-                with self.peer_lock:
-                    self.peer_failures[peer_id] = self.peer_failures.get(peer_id, 0) + 1
-                    
-                    if self.peer_failures[peer_id] >= 3:
-                        self.peers.pop(peer_id, None)
-                        self.peer_failures.pop(peer_id, None)
-                        print(f"⚠️  Peer {peer_id} removed after broadcast failures")
+        except Exception as e:
+            # Track failures but don't remove immediately
+            self._record_failure(peer_id, "broadcast failures")
+            return False
+    
+    def _record_failure(self, peer_id: str, reason: str):
+        """Count a failed send, removing the peer after MAX_PEER_FAILURES in a row"""
+        with self.peer_lock:
+            if peer_id not in self.peers:
+                return  # Already removed by a concurrent send
+            
+            self.peer_failures[peer_id] += 1
+            if self.peer_failures[peer_id] < self.MAX_PEER_FAILURES:
+                return
+            
+            del self.peers[peer_id]
+            del self.peer_failures[peer_id]
+            conn_lock = self.peer_conn_locks.pop(peer_id, None)
+            self._peers_changed()
         
-        return successful_sends
+        # Close outside peer_lock, but under the connection's own lock so an
+        # in-flight send can't leave a fresh socket behind
+        if conn_lock is not None:
+            with conn_lock:
+                self._close_connection(peer_id)
+        else:
+            self._close_connection(peer_id)
+        print(f"⚠️  Peer {peer_id} removed after {reason}")
     
     def add_message_handler(self, handler: Callable):
-        """Add a message handler callback"""
-        self.message_handlers.append(handler)
+        """Add a message handler callback (ignored if already registered)"""
+        if handler not in self.message_handlers:
+            self.message_handlers.append(handler)
     
     def get_peer_count(self) -> int:
         """Get number of connected peers"""
-        with self.peer_lock:
-            return len(self.peers)
+        return len(self._peers_snapshot)
     
     def get_peers(self) -> Dict[str, Tuple[str, int]]:
         """Get copy of connected peers dictionary"""
-        with self.peer_lock:
-            return self.peers.copy()
+        return dict(self._peers_snapshot)
     
     def stop(self):
         """Stop the P2P host"""
         self.running = False
         try:
-            self.socket.close()
-        except:
+            self._wakeup_send.send(b'\0')
+            self._wakeup_send.close()
+        except OSError:
             pass
+        # Let the accept loop exit before its listening sockets go away
+        if self.listen_thread is not None:
+            self.listen_thread.join(timeout=1.0)
+        
+        for listen_socket in (self.socket, self.unix_socket):
+            if listen_socket is None:
+                continue
+            try:
+                listen_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # ENOTCONN on platforms without listener shutdown
+            try:
+                listen_socket.close()
+            except:
+                pass
+        if self.unix_socket is not None:
+            try:
+                os.unlink(self.unix_path)
+            except OSError:
+                pass
+        self.send_pool.shutdown(wait=False)
+        try:
+            self.inbox.put_nowait(None)  # Wake the handler thread
+        except queue.Full:
+            pass  # It re-checks self.running after the message in hand
+        for peer_id in list(self.peer_conns):
+            self._close_connection(peer_id)
 
 
-def create_host(port: int) -> P2PHost:
+def create_host(port: int, ready_event: Optional[threading.Event] = None) -> P2PHost:
     """Create and start a P2P host"""
     host = P2PHost(port)
-    host.start()
+    host.start(ready_event)
     return host